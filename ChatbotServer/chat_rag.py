@@ -6,6 +6,9 @@ import numpy as np
 import pandas as pd
 import google.generativeai as genai
 import unicodedata
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 # === SỬA LỖI ĐƯỜNG DẪN ===
 # Lấy đường dẫn tuyệt đối của thư mục chứa file chat_rag.py này
@@ -14,8 +17,21 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 # Định nghĩa đường dẫn cache dựa trên BASE_DIR
 INDEX_PATH = os.path.join(BASE_DIR, "faiss_index.bin")
 DATA_PATH = os.path.join(BASE_DIR, "qa_cache.parquet")
+EMBED_BATCH_SIZE = 100  # Giới hạn số text mỗi request batchEmbedContents
 # ========================
 
+
+def normalize_question(text):
+    """Chuẩn hóa câu hỏi giống lúc load Excel: lowercase + bỏ dấu."""
+    text = unicodedata.normalize("NFKD", str(text).lower())
+    return text.encode("ascii", errors="ignore").decode("utf-8")
+
+
+def content_hash(question, answers):
+    """Hash nội dung 1 dòng Q&A, dùng để biết dòng nào cần embed lại."""
+    return hashlib.sha1(f"{question}\n{answers}".encode("utf-8")).hexdigest()
+
+
 class PetChatRAG:
     def __init__(self, api_key, data_file):
         self.api_key = api_key
@@ -26,25 +42,31 @@ class PetChatRAG:
         self.llm_model = None
         self.embedding_dimension = None
         self.similarity_threshold = 0.55
+        self._next_id = 0
+
+        # Writer lock: tuần tự hóa các thao tác admin (thêm/sửa/xóa/reload)
+        # Swap lock: chỉ giữ trong lúc đổi cặp (df, index), /chat không bị chặn
+        self._write_lock = threading.Lock()
+        self._swap_lock = threading.Lock()
 
         genai.configure(api_key=self.api_key)
         self.llm_model = genai.GenerativeModel("models/gemini-2.0-flash")
 
     # === Load data ===
+    def read_source(self):
+        df = pd.read_excel(self.data_file)
+        print(f"Data loaded from {self.data_file} ({len(df)} records)")
+        df["question"] = df["question"].apply(normalize_question)
+        df["content_hash"] = [
+            content_hash(q, a) for q, a in zip(df["question"], df["answers"])
+        ]
+        # source_hash: hash của dòng gốc trong file; None với entry thêm qua API
+        df["source_hash"] = df["content_hash"]
+        return df
+
     def load_data(self):
         try:
-            self.df = pd.read_excel(self.data_file)
-            print(f"Data loaded from {self.data_file} ({len(self.df)} records)")
-
-            self.df["question"] = (
-                self.df["question"]
-                .astype(str)
-                .str.lower()
-                .apply(lambda x: unicodedata.normalize("NFKD", x))
-                .str.encode("ascii", errors="ignore")
-                .str.decode("utf-8")
-            )
-
+            self.df = self.read_source()
             return True
         except Exception as e:
             print(f"Error loading data: {e}")
@@ -59,6 +81,22 @@ class PetChatRAG:
             print(f"Error getting embedding: {e}")
             return None
 
+    def get_embeddings(self, texts):
+        """Embed nhiều câu trong 1 request (mỗi lô EMBED_BATCH_SIZE câu)."""
+        embeddings = []
+        for i in range(0, len(texts), EMBED_BATCH_SIZE):
+            chunk = list(texts[i:i + EMBED_BATCH_SIZE])
+            try:
+                result = genai.embed_content(model=self.embedding_model_name, content=chunk)
+                if len(result["embedding"]) != len(chunk):
+                    raise ValueError(f"expected {len(chunk)} embeddings, got {len(result['embedding'])}")
+                embeddings.extend(result["embedding"])
+            except Exception as e:
+                # 1 câu lỗi làm hỏng cả lô -> embed lại từng câu để chỉ câu lỗi bị None
+                print(f"Error getting batch embeddings, retrying one by one: {e}")
+                embeddings.extend(self.get_embedding(text) for text in chunk)
+        return embeddings
+
     # === Retry wrapper for LLM ===
     def llm_generate_with_retry(self, prompt, max_retries=3, backoff=2.0):
         for attempt in range(max_retries):
@@ -71,24 +109,46 @@ class PetChatRAG:
                     time.sleep(backoff * (attempt + 1))
         return "Xin lỗi, tôi tạm thời không thể trả lời lúc này."
 
-    # === Build FAISS index (Cosine) ===
-    def build_index(self):
-        print("Building embeddings...")
-        self.df["embedding"] = (
-            self.df.apply(
-                lambda x: self.get_embedding(f"{x['question']} {x['answers']}"),
-                axis=1
-            )
+    def embed_rows(self, df):
+        df["embedding"] = df.apply(
+            lambda x: self.get_embedding(f"{x['question']} {x['answers']}"),
+            axis=1
         )
-        self.df.dropna(subset=["embedding"], inplace=True)
+        return df.dropna(subset=["embedding"])
 
-        embeddings = np.array(self.df["embedding"].tolist()).astype("float32")
-        faiss.normalize_L2(embeddings)
-        self.embedding_dimension = embeddings.shape[1]
+    # === Build FAISS index (Cosine, có ID mapping) ===
+    # ID của vector trong FAISS = cột doc_id của DataFrame, nên có thể
+    # xóa/thêm từng dòng mà không cần build lại toàn bộ index.
+    def _normalized_vectors(self, df):
+        vectors = np.array(df["embedding"].tolist()).astype("float32")
+        faiss.normalize_L2(vectors)
+        return vectors
 
-        self.index = faiss.IndexFlatIP(self.embedding_dimension)
-        self.index.add(embeddings)
-        print(f"FAISS index built successfully ({len(embeddings)} vectors).")
+    def _index_from_df(self, df):
+        index = faiss.IndexIDMap2(faiss.IndexFlatIP(self.embedding_dimension))
+        if not df.empty:
+            index.add_with_ids(self._normalized_vectors(df), df["doc_id"].to_numpy(dtype="int64"))
+        return index
+
+    def _assign_ids(self, df):
+        df = df.reset_index(drop=True)
+        df["doc_id"] = np.arange(len(df), dtype="int64")
+        if "content_hash" not in df.columns:
+            df["content_hash"] = [
+                content_hash(q, a) for q, a in zip(df["question"], df["answers"])
+            ]
+        if "source_hash" not in df.columns:
+            df["source_hash"] = df["content_hash"]
+        return df.set_index("doc_id", drop=False)
+
+    def build_index(self):
+        print("Building embeddings...")
+        self.df = self._assign_ids(self.embed_rows(self.df))
+
+        self.embedding_dimension = len(self.df["embedding"].iloc[0])
+        self.index = self._index_from_df(self.df)
+        self._next_id = len(self.df)
+        print(f"FAISS index built successfully ({self.index.ntotal} vectors).")
 
 
     # === Cache ===
@@ -105,6 +165,16 @@ class PetChatRAG:
             if os.path.exists(index_path) and os.path.exists(data_path):
                 self.index = faiss.read_index(index_path)
                 self.df = pd.read_parquet(data_path)
+                self.embedding_dimension = self.index.d
+                if "source_hash" in self.df.columns and isinstance(self.index, faiss.IndexIDMap2):
+                    self.df = self.df.set_index("doc_id", drop=False)
+                else:
+                    # Cache cũ (IndexFlatIP, không có doc_id/source_hash): dựng lại index từ embedding đã lưu
+                    print("Old cache format, rebuilding index with ID mapping...")
+                    self.df = self._assign_ids(self.df)
+                    self.index = self._index_from_df(self.df)
+                    self.save_cache(index_path, data_path)
+                self._next_id = int(self.df["doc_id"].max()) + 1 if not self.df.empty else 0
                 print(f"Cache loaded ({len(self.df)} records).")
                 return True
             return False
@@ -124,16 +194,162 @@ class PetChatRAG:
         self.save_cache()
         print("Chatbot ready with new embeddings!")
 
+    # === Hot-reload / cập nhật từng phần ===
+    def _snapshot(self):
+        with self._swap_lock:
+            return self.df, self.index
+
+    def _apply_changes(self, removed_ids, added):
+        """
+        Áp dụng thay đổi lên bản sao của index rồi đổi vào (copy-on-write).
+        removed_ids: các doc_id cần bỏ; added: DataFrame đã có doc_id và embedding.
+        Phải gọi khi đang giữ self._write_lock.
+        """
+        df, index = self._snapshot()
+        if index is None:
+            raise RuntimeError("Knowledge base chưa được khởi tạo")
+
+        new_index = faiss.clone_index(index)
+        if removed_ids:
+            new_index.remove_ids(np.array(removed_ids, dtype="int64"))
+        if not added.empty:
+            new_index.add_with_ids(self._normalized_vectors(added), added["doc_id"].to_numpy(dtype="int64"))
+
+        new_df = df.drop(index=removed_ids)
+        if not added.empty:
+            new_df = pd.concat([new_df, added.set_index("doc_id", drop=False)])
+        with self._swap_lock:
+            self.df, self.index = new_df, new_index
+        self.save_cache()
+        print(f"Knowledge base updated: -{len(removed_ids)} +{len(added)} ({new_index.ntotal} vectors).")
+
+    def _new_rows(self, rows):
+        """
+        rows: (doc_id, question, answers, source_hash).
+        Embed các dòng mới; trả về DataFrame chỉ gồm những dòng embed thành công.
+        """
+        added = pd.DataFrame(rows, columns=["doc_id", "question", "answers", "source_hash"])
+        if added.empty:
+            return added
+        added["content_hash"] = [
+            content_hash(q, a) for q, a in zip(added["question"], added["answers"])
+        ]
+        return self.embed_rows(added)
+
+    def add_entry(self, question, answers):
+        with self._write_lock:
+            doc_id = self._next_id
+            added = self._new_rows([(doc_id, normalize_question(question), str(answers), None)])
+            if added.empty:
+                raise RuntimeError("Không tạo được embedding cho câu hỏi mới")
+            self._next_id += 1
+            self._apply_changes([], added)
+            return doc_id
+
+    def update_entry(self, doc_id, question=None, answers=None):
+        with self._write_lock:
+            df, _ = self._snapshot()
+            if doc_id not in df.index:
+                raise KeyError(f"Không tìm thấy doc_id {doc_id}")
+            row = df.loc[doc_id]
+            new_question = normalize_question(question) if question is not None else row["question"]
+            new_answers = str(answers) if answers is not None else row["answers"]
+            if content_hash(new_question, new_answers) == row["content_hash"]:
+                return False
+
+            # Giữ source_hash: reload sau này vẫn nhận ra đây là dòng của file đã được sửa
+            added = self._new_rows([(doc_id, new_question, new_answers, row["source_hash"])])
+            if added.empty:
+                raise RuntimeError("Không tạo được embedding cho nội dung mới")
+            self._apply_changes([doc_id], added)
+            return True
+
+    def delete_entry(self, doc_id):
+        with self._write_lock:
+            df, _ = self._snapshot()
+            if doc_id not in df.index:
+                raise KeyError(f"Không tìm thấy doc_id {doc_id}")
+            self._apply_changes([doc_id], pd.DataFrame())
+
+    def reload_from_source(self):
+        """
+        Đọc lại file Excel và chỉ embed các dòng mới/đã sửa trong file.
+        Chỉ so sánh với các dòng có nguồn gốc từ file (theo source_hash):
+        - entry thêm qua API không bị đụng tới;
+        - dòng của file đã sửa qua API được giữ bản sửa, trừ khi dòng đó trong file cũng đổi;
+        - dòng của file đã xóa qua API sẽ quay lại nếu vẫn còn trong file.
+        """
+        with self._write_lock:
+            source = self.read_source()
+            df, _ = self._snapshot()
+
+            # source_hash -> danh sách doc_id hiện có (cho phép câu hỏi trùng lặp)
+            existing = {}
+            for doc_id, h in zip(df["doc_id"], df["source_hash"]):
+                if isinstance(h, str):
+                    existing.setdefault(h, []).append(int(doc_id))
+
+            rows, unchanged = [], 0
+            for q, a, h in zip(source["question"], source["answers"], source["content_hash"]):
+                if existing.get(h):
+                    existing[h].pop()
+                    unchanged += 1
+                else:
+                    rows.append((self._next_id, q, a, h))
+                    self._next_id += 1
+
+            stale_ids = [doc_id for ids in existing.values() for doc_id in ids]
+            added = self._new_rows(rows)
+
+            # Dòng mới embed lỗi (vd. Gemini tạm lỗi): giữ lại bản cũ thay vì xóa mất.
+            # Bản cũ ứng với dòng lỗi = cùng câu hỏi; nếu có dòng lỗi không ghép được
+            # với bản cũ nào thì không xóa gì cả. Bản cũ giữ lại vẫn mang source_hash cũ
+            # nên lần reload sau sẽ thử lại.
+            added_ids = set(added["doc_id"])
+            failed_questions = {q for doc_id, q, _, _ in rows if doc_id not in added_ids}
+            if failed_questions:
+                stale_questions = {df.loc[doc_id, "question"] for doc_id in stale_ids}
+                if failed_questions <= stale_questions:
+                    removed_ids = [i for i in stale_ids if df.loc[i, "question"] not in failed_questions]
+                else:
+                    removed_ids = []
+            else:
+                removed_ids = stale_ids
+
+            if removed_ids or not added.empty:
+                self._apply_changes(removed_ids, added)
+
+            return {
+                "added": len(added),
+                "removed": len(removed_ids),
+                "unchanged": unchanged,
+                "failed": len(rows) - len(added),
+                "kept_stale": len(stale_ids) - len(removed_ids),
+            }
+
     # === Retrieval ===
     def find_relevant_answers(self, query, k=3):
         query_emb = self.get_embedding(query)
         if query_emb is None:
             return pd.DataFrame(), []
 
-        q_vec = np.array([query_emb], dtype="float32")
-        faiss.normalize_L2(q_vec)
-        D, I = self.index.search(q_vec, k)
-        return self.df.iloc[I[0]], D[0]
+        return self.search_batch([query_emb], k)[0]
+
+    def search_batch(self, query_embs, k=3):
+        """1 lần FAISS search cho nhiều câu hỏi; câu nào không có embedding trả về rỗng."""
+        results = [(pd.DataFrame(), []) for _ in query_embs]
+        valid = [i for i, emb in enumerate(query_embs) if emb is not None]
+        if not valid:
+            return results
+
+        df, index = self._snapshot()
+        q_vecs = np.array([query_embs[i] for i in valid], dtype="float32")
+        faiss.normalize_L2(q_vecs)
+        D, I = index.search(q_vecs, k)
+        for row, i in enumerate(valid):
+            found = I[row] >= 0
+            results[i] = (df.loc[I[row][found]], D[row][found])
+        return results
 
     # === Generation ===
     def generate_answer(self, query, relevant_data):
@@ -159,11 +375,13 @@ class PetChatRAG:
         return self.llm_generate_with_retry(prompt)
 
     # === Chat (Đã sửa để nhận diện Chào hỏi xã giao) ===
-    def chat(self, query, k=3):
+    def chat(self, query, k=3, retrieved=None):
         start = time.time()
         
-        # Tìm kiếm dữ liệu liên quan
-        relevant, scores = self.find_relevant_answers(query, k)
+        # Tìm kiếm dữ liệu liên quan (chat_batch truyền sẵn kết quả search)
+        if retrieved is None:
+            retrieved = self.find_relevant_answers(query, k)
+        relevant, scores = retrieved
 
         max_sim = max(scores) if len(scores) else 0.0
         print(f"Max similarity = {max_sim:.3f} (threshold = {self.similarity_threshold})")
@@ -215,4 +433,20 @@ class PetChatRAG:
             "similar_documents": docs,
             "processing_time": round(time.time() - start, 2),
             "max_similarity": round(max_sim, 3)
-        }
\ No newline at end of file
+        }
+
+    # === Batch chat: 1 request embedding + 1 lần search cho cả lô ===
+    def chat_batch(self, queries, k=3, max_workers=4):
+        embeddings = self.get_embeddings(queries)
+        retrieved = self.search_batch(embeddings, k)
+
+        def run(i):
+            if embeddings[i] is None:
+                return {"status": "error", "error": "Không tạo được embedding cho câu hỏi"}
+            try:
+                return {"status": "ok", **self.chat(queries[i], k, retrieved=retrieved[i])}
+            except Exception as e:
+                return {"status": "error", "error": str(e)}
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            return list(pool.map(run, range(len(queries))))
@@ -7,15 +7,27 @@ import pandas as pd
 import google.generativeai as genai
 import unicodedata
 from pymongo import MongoClient, errors
-from threading import Thread
+from threading import Thread, Lock
+from concurrent.futures import ThreadPoolExecutor
 
 # === SỬA LỖI ĐƯỜNG DẪN ===
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 SHOP_INDEX_PATH = os.path.join(BASE_DIR, "shop_faiss.bin")
 SHOP_DATA_PATH = os.path.join(BASE_DIR, "shop_cache.parquet")
+EMBED_BATCH_SIZE = 100  # Giới hạn số text mỗi request batchEmbedContents
+
+# Giá/kho không nằm trong full_text: lưu ở bảng nóng self.live, cập nhật trực tiếp
+# từ change stream và ghép vào kết quả lúc trả lời -> đổi giá/kho không cần re-embed.
+LIVE_FIELDS = ["price", "sale_price", "stock_quantity"]
+# Chỉ khi các field này đổi mới cần build lại embedding
+EMBEDDED_FIELDS = {"name", "description", "category"}
 # ========================
 
 
+class ReindexCancelled(Exception):
+    """Job reindex bị hủy giữa chừng; index cũ được giữ nguyên."""
+
+
 class ShopRAGMongo:
     def __init__(self, api_key, mongo_uri, db_name="TINYPAWS", collection="products", categories_collection="categories"):
         self.api_key = api_key
@@ -32,6 +44,12 @@ class ShopRAGMongo:
         self.db_collection = None
         self.embedding_dimension = 768
         self.similarity_threshold = 0.55 # Có thể giảm xuống 0.5 nếu muốn tìm rộng hơn
+        self._reload_lock = Lock() # Không cho 2 lần rebuild chạy cùng lúc
+        self._swap_lock = Lock() # Giữ cặp (df, index) luôn khớp nhau khi đổi/đọc
+        self.live = {} # _id -> {price, sale_price, stock_quantity}
+        self._live_ts = {} # _id -> thời điểm watcher ghi/xóa gần nhất (để merge với snapshot)
+        self._deleted = set() # Tombstone: _id đã bị xóa khỏi DB nhưng có thể còn trong index
+        self._live_lock = Lock()
 
         genai.configure(api_key=self.api_key)
         self.llm_model = genai.GenerativeModel("models/gemini-2.0-flash")
@@ -63,60 +81,127 @@ class ShopRAGMongo:
     def load_data(self):
         if self.db_collection is None:
             return False
-            
+
         try:
-            # Bước 1: Lấy từ điển danh mục về trước
-            cat_map = self.get_category_map()
-            print(f"Đã tải {len(cat_map)} danh mục để tham chiếu.")
-
-            # Bước 2: Lấy sản phẩm (Lấy cả cột category)
-            # Lưu ý: dùng stock_quantity theo đúng DB của bạn
-            projection = {
-                "name": 1, "description": 1, "price": 1, 
-                "sale_price": 1, "stock_quantity": 1, "category": 1
-            }
-            products = list(self.db_collection.find({}, projection))
-            
-            if not products:
-                 print("MongoDB rỗng.")
-                 self.df = pd.DataFrame()
-                 return True
-
-            self.df = pd.DataFrame(products)
-            self.df["_id"] = self.df["_id"].astype(str)
-            if "category" in self.df.columns:
-                self.df["category"] = self.df["category"].astype(str)
-            
-            # Bước 3: Tạo hàm xử lý từng dòng để gắn Tên Danh Mục vào
-            def create_full_text(row):
-                # Xử lý giá
-                price_str = f"{row.get('price', 0)}"
-                if row.get('sale_price') and row.get('sale_price') > 0:
-                    price_str = f"{row['sale_price']} (Gốc: {row['price']})"
-                
-                # --- QUAN TRỌNG: LOOKUP CATEGORY ---
-                # Lấy ID category từ sản phẩm
-                cat_id = str(row.get('category', ''))
-                # Tra cứu trong từ điển. Nếu không thấy thì để là "Sản phẩm"
-                cat_name = cat_map.get(cat_id, "Sản phẩm")
-                # -----------------------------------
-
-                # Ghép chuỗi thông minh: Đưa Tên Danh Mục lên đầu
-                return (
-                    f"Loại: {cat_name}. "  # <-- AI sẽ nhìn thấy chữ "Thức ăn" ở đây
-                    f"Tên: {row['name']}. "
-                    f"Mô tả: {row.get('description', '')}. "
-                    f"Giá: {price_str} VND. "
-                    f"Kho: {row.get('stock_quantity', 0)}"
-                )
-
-            self.df["full_text"] = self.df.apply(create_full_text, axis=1)
+            self.df = self.fetch_products()
             return True
-
         except Exception as e:
             print(f"Lỗi load data: {e}")
             return False
+
+    def fetch_products(self):
+        """Đọc sản phẩm từ MongoDB thành DataFrame (chưa có embedding)."""
+        # Bước 1: Lấy từ điển danh mục về trước
+        cat_map = self.get_category_map()
+        print(f"Đã tải {len(cat_map)} danh mục để tham chiếu.")
+
+        # Bước 2: Lấy sản phẩm (Lấy cả cột category)
+        # Lưu ý: dùng stock_quantity theo đúng DB của bạn
+        projection = {
+            "name": 1, "description": 1, "price": 1, 
+            "sale_price": 1, "stock_quantity": 1, "category": 1
+        }
+        products = list(self.db_collection.find({}, projection))
+        
+        if not products:
+             print("MongoDB rỗng.")
+             return pd.DataFrame()
+
+        df = pd.DataFrame(products)
+        df["_id"] = df["_id"].astype(str)
+        if "category" in df.columns:
+            df["category"] = df["category"].astype(str)
+        
+        # Bước 3: Tạo hàm xử lý từng dòng để gắn Tên Danh Mục vào
+        # (Giá/kho KHÔNG đưa vào full_text, xem LIVE_FIELDS)
+        def create_full_text(row):
+            # --- QUAN TRỌNG: LOOKUP CATEGORY ---
+            # Lấy ID category từ sản phẩm
+            cat_id = str(row.get('category', ''))
+            # Tra cứu trong từ điển. Nếu không thấy thì để là "Sản phẩm"
+            cat_name = cat_map.get(cat_id, "Sản phẩm")
+            # -----------------------------------
+
+            # Ghép chuỗi thông minh: Đưa Tên Danh Mục lên đầu
+            return (
+                f"Loại: {cat_name}. "  # <-- AI sẽ nhìn thấy chữ "Thức ăn" ở đây
+                f"Tên: {row['name']}. "
+                f"Mô tả: {row.get('description', '')}."
+            )
+
+        df["full_text"] = df.apply(create_full_text, axis=1)
+        return df
     
+    # === Bảng nóng giá/kho ===
+    @staticmethod
+    def live_entry(doc):
+        return {field: doc.get(field) for field in LIVE_FIELDS}
+
+    def set_live(self, product_id, entry):
+        with self._live_lock:
+            self.live[product_id] = entry
+            self._live_ts[product_id] = time.monotonic()
+            self._deleted.discard(product_id)
+
+    def patch_live(self, product_id, fields):
+        """Sửa vài field của entry đã có; không có entry thì bỏ qua (trả về False)."""
+        with self._live_lock:
+            if product_id not in self.live:
+                return False
+            self.live[product_id] = {**self.live[product_id], **fields}
+            self._live_ts[product_id] = time.monotonic()
+            return True
+
+    def drop_live(self, product_id):
+        with self._live_lock:
+            self.live.pop(product_id, None)
+            self._live_ts[product_id] = time.monotonic()
+            self._deleted.add(product_id)
+
+    def merge_live(self, entries, fetched_at):
+        """
+        Thay bảng giá/kho bằng snapshot đọc từ DB lúc fetched_at (time.monotonic()).
+        Sản phẩm mà watcher đã ghi/xóa SAU fetched_at giữ nguyên giá trị của watcher,
+        sản phẩm không còn trong snapshot thì bị bỏ và ghi tombstone (kể cả khi catalog rỗng).
+        """
+        with self._live_lock:
+            newer = {pid for pid, ts in self._live_ts.items() if ts >= fetched_at}
+            live = {pid: e for pid, e in entries.items() if pid not in newer}
+            live.update({pid: self.live[pid] for pid in newer if pid in self.live})
+            self._deleted = (self._deleted | set(self.live)) - set(live)
+            self.live = live
+            self._live_ts = {pid: self._live_ts[pid] for pid in newer}
+
+    def refresh_live_table(self):
+        """Tải lại toàn bộ giá/kho (1 query nhỏ, không embed)."""
+        if self.db_collection is None:
+            return
+        try:
+            fetched_at = time.monotonic()
+            projection = {field: 1 for field in LIVE_FIELDS}
+            entries = {str(doc["_id"]): self.live_entry(doc) for doc in self.db_collection.find({}, projection)}
+            self.merge_live(entries, fetched_at)
+            print(f"Bảng giá/kho đã tải ({len(self.live)} sản phẩm).")
+        except Exception as e:
+            print(f"Lỗi tải bảng giá/kho: {e}")
+
+    def with_live(self, df):
+        """
+        Ghép giá/kho hiện tại vào các dòng tìm được.
+        - Sản phẩm có tombstone (đã xóa, index chưa build lại): bỏ dòng.
+        - Chưa có trong bảng nóng (vd. chưa tải được từ MongoDB): giữ giá/kho trong cache.
+        """
+        if df.empty or "_id" not in df.columns:
+            return df
+        with self._live_lock:
+            live = {pid: self.live[pid] for pid in df["_id"] if pid in self.live}
+            deleted = {pid for pid in df["_id"] if pid in self._deleted}
+        df = df[~df["_id"].isin(deleted)].copy()
+        for field in LIVE_FIELDS:
+            cached = df[field].tolist() if field in df.columns else [None] * len(df)
+            df[field] = [live[pid][field] if pid in live else old for pid, old in zip(df["_id"], cached)]
+        return df
+
     # === Embedding ===
     def get_embedding(self, text):
         try:
@@ -126,6 +211,22 @@ class ShopRAGMongo:
             print(f"Error getting embedding: {e}")
             return None
 
+    def get_embeddings(self, texts):
+        """Embed nhiều câu trong 1 request (mỗi lô EMBED_BATCH_SIZE câu)."""
+        embeddings = []
+        for i in range(0, len(texts), EMBED_BATCH_SIZE):
+            chunk = list(texts[i:i + EMBED_BATCH_SIZE])
+            try:
+                result = genai.embed_content(model=self.embedding_model_name, content=chunk)
+                if len(result["embedding"]) != len(chunk):
+                    raise ValueError(f"expected {len(chunk)} embeddings, got {len(result['embedding'])}")
+                embeddings.extend(result["embedding"])
+            except Exception as e:
+                # 1 câu lỗi làm hỏng cả lô -> embed lại từng câu để chỉ câu lỗi bị None
+                print(f"Error getting batch embeddings, retrying one by one: {e}")
+                embeddings.extend(self.get_embedding(text) for text in chunk)
+        return embeddings
+
     # === Retry wrapper for LLM ===
     def llm_generate_with_retry(self, prompt, max_retries=3, backoff=2.0):
         for attempt in range(max_retries):
@@ -141,37 +242,67 @@ class ShopRAGMongo:
 
     # === Build FAISS index (Cosine) ===
     def build_index(self):
+        self._swap(*self.embed_and_index(self.df))
+
+    def _snapshot(self):
+        with self._swap_lock:
+            return self.df, self.index
+
+    def _swap(self, df, index):
+        with self._swap_lock:
+            self.df, self.index = df, index
+
+    def embed_and_index(self, df, progress=None, cancel_event=None):
+        """
+        Tạo embedding + FAISS index cho df mà không đụng tới self.df/self.index.
+        progress: dict được cập nhật số sản phẩm đã embed/embed lỗi/index (cho job status).
+        cancel_event: threading.Event, nếu được set thì dừng và raise ReindexCancelled.
+        """
         print("Đang tạo embeddings cho sản phẩm...")
-        if self.df.empty or 'full_text' not in self.df.columns:
+        if progress is None:
+            progress = {}
+        if df.empty or 'full_text' not in df.columns:
             print("DataFrame rỗng, không thể build index.")
-            self.index = faiss.IndexFlatIP(self.embedding_dimension) 
-            return
+            return df, faiss.IndexFlatIP(self.embedding_dimension)
+
+        embeddings = []
+        progress["embedded"] = progress["failed"] = 0
+        for text in df["full_text"].astype(str):
+            if cancel_event is not None and cancel_event.is_set():
+                raise ReindexCancelled("Reindex đã bị hủy")
+            embedding = self.get_embedding(text)
+            embeddings.append(embedding)
+            if embedding is None:
+                progress["failed"] += 1
+            else:
+                progress["embedded"] += 1
 
-        self.df["embedding"] = (
-            self.df["full_text"].astype(str).apply(self.get_embedding)
-        )
-        self.df.dropna(subset=["embedding"], inplace=True)
+        df = df.copy()
+        df["embedding"] = embeddings
+        df.dropna(subset=["embedding"], inplace=True)
 
-        if self.df.empty:
+        if df.empty:
             print("Không có embedding nào được tạo, index sẽ rỗng.")
-            self.index = faiss.IndexFlatIP(self.embedding_dimension)
-            return
+            return df, faiss.IndexFlatIP(self.embedding_dimension)
 
-        embeddings = np.array(self.df["embedding"].tolist()).astype("float32")
-        faiss.normalize_L2(embeddings)
-        self.embedding_dimension = embeddings.shape[1]
+        vectors = np.array(df["embedding"].tolist()).astype("float32")
+        faiss.normalize_L2(vectors)
+        self.embedding_dimension = vectors.shape[1]
 
-        self.index = faiss.IndexFlatIP(self.embedding_dimension)
-        self.index.add(embeddings)
-        print(f"FAISS index được tạo với {len(self.df)} sản phẩm.")
+        index = faiss.IndexFlatIP(self.embedding_dimension)
+        index.add(vectors)
+        progress["indexed"] = index.ntotal
+        print(f"FAISS index được tạo với {len(df)} sản phẩm.")
+        return df, index
 
     # === Cache ===
     def save_cache(self, index_path=SHOP_INDEX_PATH, data_path=SHOP_DATA_PATH):
         try:
-            if self.index:
-                faiss.write_index(self.index, index_path)
-            if not self.df.empty:
-                self.df.to_parquet(data_path, index=False, engine='pyarrow')
+            df, index = self._snapshot()
+            if index:
+                faiss.write_index(index, index_path)
+            if not df.empty:
+                df.to_parquet(data_path, index=False, engine='pyarrow')
             print(f"Cache shop đã lưu: {index_path}, {data_path}")
         except Exception as e:
             print(f"Lỗi lưu cache: {e}")
@@ -179,10 +310,11 @@ class ShopRAGMongo:
     def load_cache(self, index_path=SHOP_INDEX_PATH, data_path=SHOP_DATA_PATH):
         try:
             if os.path.exists(index_path) and os.path.exists(data_path):
-                self.index = faiss.read_index(index_path)
-                self.df = pd.read_parquet(data_path, engine='pyarrow')
-                self.embedding_dimension = self.index.d
-                print(f"Cache shop đã tải ({len(self.df)} sản phẩm).")
+                index = faiss.read_index(index_path)
+                df = pd.read_parquet(data_path, engine='pyarrow')
+                self._swap(df, index)
+                self.embedding_dimension = index.d
+                print(f"Cache shop đã tải ({len(df)} sản phẩm).")
                 return True
             print("Không tìm thấy cache shop, sẽ build lại từ MongoDB.")
             return False
@@ -191,41 +323,55 @@ class ShopRAGMongo:
             return False
 
     # === Setup ===
-    def setup(self, start_watcher=False):
+    def setup(self, start_watcher=False, request_reindex=None):
         print("Đang khởi tạo ShopRAG...")
         if self.load_cache():
             print("ShopRAG đã tải từ cache!")
         else:
             if not self.load_data():
                 print("Không thể tải data shop. Bỏ qua build index.")
-                self.index = faiss.IndexFlatIP(self.embedding_dimension) 
+                self._swap(self.df, faiss.IndexFlatIP(self.embedding_dimension))
             else:
                 self.build_index()
                 self.save_cache()
             
+        self.refresh_live_table()
         print("ShopRAG sẵn sàng!")
         
         if start_watcher and self.db_collection is not None:
-            self.start_change_stream_watcher()
+            self.start_change_stream_watcher(request_reindex)
     
     # === Retrieval: Hybrid Search (Vector + Keyword) ===
-    def find_relevant_products(self, query, k=8):
-        # 1. Tìm kiếm bằng Vector (Cũ)
-        query_emb = self.get_embedding(query)
-        vector_results = pd.DataFrame()
-        
-        if query_emb is not None and self.index and self.index.ntotal > 0:
-            q_vec = np.array([query_emb], dtype="float32")
-            faiss.normalize_L2(q_vec)
-            D, I = self.index.search(q_vec, k)
-            vector_results = self.df.iloc[I[0]].copy()
+    def vector_search_batch(self, query_embs, k=8, snapshot=None):
+        """1 lần FAISS search cho nhiều câu hỏi; trả về list DataFrame (có cột score)."""
+        results = [pd.DataFrame() for _ in query_embs]
+        df, index = snapshot or self._snapshot()
+        valid = [i for i, emb in enumerate(query_embs) if emb is not None]
+        if not valid or not index or index.ntotal == 0:
+            return results
+
+        q_vecs = np.array([query_embs[i] for i in valid], dtype="float32")
+        faiss.normalize_L2(q_vecs)
+        D, I = index.search(q_vecs, k)
+        for row, i in enumerate(valid):
+            found = I[row] >= 0
+            results[i] = df.iloc[I[row][found]].copy()
             # Gán điểm giả lập cho vector search
-            vector_results["score"] = D[0]
+            results[i]["score"] = D[row][found]
+        return results
+
+    def find_relevant_products(self, query, k=8, vector_results=None):
+        # Dùng 1 snapshot (df, index) cho cả lượt tìm, tránh lệch khi reindex đổi index giữa chừng
+        df, index = self._snapshot()
+
+        # 1. Tìm kiếm bằng Vector (chat_batch truyền sẵn kết quả search)
+        if vector_results is None:
+            vector_results = self.vector_search_batch([self.get_embedding(query)], k, (df, index))[0]
 
         # 2. Tìm kiếm bằng Từ khóa (Mới - Keyword Search)
         # Mục đích: Bắt dính các từ chuyên môn như "sỏi thận", "triệt sản", "royal canin"...
         keyword_results = pd.DataFrame()
-        if not self.df.empty:
+        if not df.empty:
             query_lower = query.lower()
             # Tách câu hỏi thành các từ quan trọng (bỏ qua các từ vô nghĩa nếu muốn)
             # Ở đây ta tìm các dòng mà cột full_text chứa cụm từ người dùng hỏi
@@ -238,12 +384,12 @@ class ShopRAGMongo:
             for kw in important_keywords:
                 if kw in query_lower:
                     # Tìm các dòng chứa từ khóa này
-                    matches = self.df[self.df["full_text"].str.contains(kw, case=False, na=False)]
+                    matches = df[df["full_text"].str.contains(kw, case=False, na=False)]
                     if not matches.empty:
                         matched_indices.update(matches.index.tolist())
 
             if matched_indices:
-                keyword_results = self.df.loc[list(matched_indices)].copy()
+                keyword_results = df.loc[list(matched_indices)].copy()
                 keyword_results["score"] = 1.0 # Gán điểm cao nhất cho kết quả khớp từ khóa
 
         # 3. Gộp kết quả (Merge)
@@ -278,11 +424,16 @@ class ShopRAGMongo:
             full_text_str = str(row.get('full_text', ''))
             category_info = full_text_str.split('.')[0] if "Loại:" in full_text_str else f"Loại: {row.get('category', 'Sản phẩm')}"
 
-            # 3. Tạo chuỗi thông tin gọn nhẹ
+            # 3. Giá/kho lấy từ bảng nóng (đã ghép trong chat)
+            price_str = f"{row.get('price', 0)}"
+            if row.get('sale_price') and row.get('sale_price') > 0:
+                price_str = f"{row['sale_price']} (Gốc: {row['price']})"
+
+            # 4. Tạo chuỗi thông tin gọn nhẹ
             item_str = (
                 f"{category_info} | "
                 f"Tên: {row['name']} | "
-                f"Giá: {row['price']} | "
+                f"Giá: {price_str} | "
                 f"Kho: {row['stock_quantity']} | "
                 f"Mô tả: {short_desc}"
             )
@@ -313,11 +464,11 @@ class ShopRAGMongo:
 
     # === Chat (có Bộ Lọc Cứng - Hard Filter) ===
     # === Chat (Đã thêm logic Chào hỏi & Bộ lọc cứng) ===
-    def chat(self, query, k=8):
+    def chat(self, query, k=8, vector_results=None):
         start = time.time()
         
         # 1. Tìm kiếm rộng (k=8)
-        relevant, scores = self.find_relevant_products(query, k)
+        relevant, scores = self.find_relevant_products(query, k, vector_results)
         
         max_score = 0.0
         if len(scores) > 0:
@@ -389,6 +540,7 @@ class ShopRAGMongo:
         
         # Trường hợp 2: Tìm thấy sản phẩm (Điểm cao)
         else:
+            relevant = self.with_live(relevant)
             # Gọi hàm generate_answer bình thường
             answer = self.generate_answer(query, relevant)
             docs = relevant[["name", "description", "price", "stock_quantity"]].replace({np.nan: None}).to_dict("records")
@@ -400,16 +552,93 @@ class ShopRAGMongo:
             "max_similarity": float(max_score)
         }
         
+    # === Batch chat: 1 request embedding + 1 lần search cho cả lô ===
+    def chat_batch(self, queries, k=8, max_workers=4):
+        embeddings = self.get_embeddings(queries)
+        vector_results = self.vector_search_batch(embeddings, k)
+
+        def run(i):
+            if embeddings[i] is None:
+                return {"status": "error", "error": "Không tạo được embedding cho câu hỏi"}
+            try:
+                return {"status": "ok", **self.chat(queries[i], k, vector_results[i])}
+            except Exception as e:
+                return {"status": "error", "error": str(e)}
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            return list(pool.map(run, range(len(queries))))
+
     # === Real-time watcher ===
-    def reload_index(self):
-        """Hàm này được gọi khi có thay đổi trong DB"""
-        print("Phát hiện thay đổi MongoDB! Đang build lại index...")
-        if self.load_data():
-            self.build_index()
+    def reload_index(self, progress=None, cancel_event=None):
+        """
+        Hàm này được gọi khi có thay đổi trong DB (watcher hoặc job admin).
+        Index mới được build riêng rồi mới đổi vào, nên /chat vẫn dùng index cũ
+        trong lúc build và index cũ được giữ nguyên nếu lỗi/bị hủy.
+        """
+        if progress is None:
+            progress = {}
+        with self._reload_lock:
+            print("Phát hiện thay đổi MongoDB! Đang build lại index...")
+            if self.db_collection is None:
+                raise RuntimeError("Chưa kết nối MongoDB")
+            fetched_at = time.monotonic()
+            df = self.fetch_products()
+            progress["loaded"] = len(df)
+            self.merge_live({row["_id"]: self.live_entry(row) for row in df.to_dict("records")}, fetched_at)
+
+            df, index = self.embed_and_index(df, progress, cancel_event)
+            if cancel_event is not None and cancel_event.is_set():
+                raise ReindexCancelled("Reindex đã bị hủy")
+
+            self._swap(df, index)
             self.save_cache()
             print("Index shop đã được cập nhật.")
         
-    def start_change_stream_watcher(self):
+    def _reload_index_safe(self):
+        try:
+            self.reload_index()
+        except Exception as e:
+            print(f"Lỗi reload index: {e}")
+
+    def apply_live_change(self, change):
+        """
+        Cập nhật bảng giá/kho từ 1 change event (O(1)).
+        Trả về True nếu thay đổi chạm tới nội dung đã embed -> cần reindex.
+        """
+        op = change['operationType']
+        product_id = str(change['documentKey']['_id'])
+
+        if op == 'delete':
+            self.drop_live(product_id)
+            return True
+
+        doc = change.get('fullDocument')
+        if doc:
+            self.set_live(product_id, self.live_entry(doc))
+
+        if op != 'update':
+            return True
+
+        desc = change.get('updateDescription') or {}
+        updated = desc.get('updatedFields') or {}
+        if not doc:
+            fields = {f: v for f, v in updated.items() if f in LIVE_FIELDS}
+            if fields and not self.patch_live(product_id, fields):
+                # Không có entry để vá -> bỏ qua, with_live sẽ dùng giá/kho trong cache
+                print(f"Không có giá/kho của {product_id} trong bảng nóng, bỏ qua event.")
+
+        changed = {f.split('.')[0] for f in list(updated) + list(desc.get('removedFields') or [])}
+        if changed & EMBEDDED_FIELDS:
+            return True
+        print(f"Chỉ đổi {sorted(changed)} -> cập nhật bảng giá/kho, không reindex.")
+        return False
+
+    def start_change_stream_watcher(self, request_reindex=None):
+        """
+        Watcher chỉ cập nhật bảng giá/kho; việc build lại index được giao cho
+        request_reindex() (vd. JobRunner.submit) để vòng lặp không bị chặn
+        trong lúc re-embed. Không truyền thì build trong 1 thread riêng.
+        """
         print("Theo dõi thay đổi MongoDB (auto reload)...")
         # === SỬA LỖI "is not None" ===
         if self.db_collection is None:
@@ -429,9 +658,16 @@ class ShopRAGMongo:
                 with self.db_collection.watch(full_document='updateLookup') as stream:
                     for change in stream:
                         print(f"MongoDB change detected: {change['operationType']}")
-                        # Đơn giản là build lại mọi thứ khi có thay đổi
                         if change['operationType'] in ['insert', 'update', 'replace', 'delete']:
-                            self.reload_index()
+                            if not self.apply_live_change(change):
+                                continue
+                            try:
+                                if request_reindex:
+                                    request_reindex()
+                                else:
+                                    Thread(target=self._reload_index_safe, daemon=True).start()
+                            except Exception as e:
+                                print(f"Lỗi reload index: {e}")
             except Exception as e:
                 print(f"Lỗi Change Stream watcher: {e}")
 
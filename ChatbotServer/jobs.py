@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+import time
+import uuid
+from threading import Thread, Lock, Event
+
+from chat_shop import ReindexCancelled
+
+
+class ReindexJob:
+    def __init__(self, name):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.status = "pending"  # pending -> running -> succeeded | failed | cancelled
+        self.progress = {}
+        self.reset_progress()
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.cancel_event = Event()
+        self.rerun_requested = False  # có thay đổi mới trong lúc chạy -> chạy lại 1 lần
+
+    def reset_progress(self):
+        # Cập nhật tại chỗ: target giữ tham chiếu tới dict này
+        self.progress.clear()
+        self.progress.update({"loaded": 0, "embedded": 0, "failed": 0, "indexed": 0})
+
+    @property
+    def done(self):
+        return self.status in ("succeeded", "failed", "cancelled")
+
+    def to_dict(self):
+        end = self.finished_at or time.time()
+        return {
+            "job_id": self.id,
+            "name": self.name,
+            "status": self.status,
+            "progress": dict(self.progress),
+            "error": self.error,
+            "duration": round(end - self.started_at, 2) if self.started_at else 0,
+            "cancel_requested": self.cancel_event.is_set(),
+            "rerun_requested": self.rerun_requested,
+        }
+
+
+class JobRunner:
+    """
+    Chạy các job reindex trong thread nền.
+    Single-flight: mỗi tên job chỉ có 1 job đang chạy, gọi lại sẽ nhận job cũ.
+    Với rerun=True (watcher), job đang chạy sẽ chạy lại thêm 1 lần sau khi xong
+    để không bỏ sót thay đổi đến sau lúc nó đọc dữ liệu.
+    """
+
+    def __init__(self, max_history=50):
+        self.max_history = max_history
+        self._jobs = {}    # job_id -> ReindexJob
+        self._active = {}  # name -> ReindexJob đang chạy
+        self._lock = Lock()
+
+    def submit(self, name, target, rerun=False):
+        """
+        target(progress=..., cancel_event=...) chạy trong thread riêng.
+        Trả về (job, created); created=False nếu đã có job cùng tên đang chạy.
+        """
+        with self._lock:
+            active = self._active.get(name)
+            if active and not active.done:
+                if rerun:
+                    active.rerun_requested = True
+                return active, False
+
+            job = ReindexJob(name)
+            self._jobs[job.id] = job
+            self._active[name] = job
+            self._trim_history()
+
+        def run():
+            job.status = "running"
+            job.started_at = time.time()
+            print(f"Job {name} ({job.id}) bắt đầu.")
+            while True:
+                # Mỗi lượt (kể cả lượt chạy lại) báo tiến độ riêng
+                job.reset_progress()
+                status, error = "succeeded", None
+                try:
+                    target(progress=job.progress, cancel_event=job.cancel_event)
+                except ReindexCancelled:
+                    status = "cancelled"
+                except Exception as e:
+                    status, error = "failed", str(e)
+
+                # Kiểm tra rerun và kết thúc job trong cùng 1 lock với submit()
+                with self._lock:
+                    if job.rerun_requested and status != "cancelled":
+                        job.rerun_requested = False
+                        print(f"Job {name} ({job.id}) có thay đổi mới, chạy lại.")
+                        continue
+                    job.status, job.error = status, error
+                    job.finished_at = time.time()
+                    break
+            print(f"Job {name} ({job.id}) kết thúc: {job.status}.")
+
+        Thread(target=run, daemon=True).start()
+        return job, True
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def cancel(self, job_id):
+        job = self._jobs.get(job_id)
+        if job is None:
+            return None
+        if not job.done:
+            job.cancel_event.set()
+        return job
+
+    def _trim_history(self):
+        finished = [j for j in self._jobs.values() if j.done]
+        for job in finished[:max(0, len(self._jobs) - self.max_history)]:
+            del self._jobs[job.id]
@@ -1,12 +1,15 @@
 from fastapi import FastAPI
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, StringConstraints
+from typing import Annotated
 from fastapi.middleware.cors import CORSMiddleware
 from chat_rag import PetChatRAG
 from chat_shop import ShopRAGMongo
+from jobs import JobRunner
 import os
 import time
 from dotenv import load_dotenv
 import asyncio
+from functools import partial
 
 # === SỬA LỖI ĐƯỜNG DẪN ===
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -39,6 +42,13 @@ pet_rag: PetChatRAG | None = None
 shop_rag: ShopRAGMongo | None = None
 # ----------------------------------------
 
+# Job reindex chạy nền, tránh block event loop khi re-embed toàn bộ catalog
+jobs = JobRunner()
+
+def request_shop_reindex():
+    """Watcher gọi khi nội dung sản phẩm đổi; gộp vào job reindex đang chạy nếu có."""
+    return jobs.submit("reindex_shop", shop_rag.reload_index, rerun=True)
+
 @app.on_event("startup")
 async def load_models_on_startup():
     """
@@ -59,7 +69,7 @@ async def load_models_on_startup():
     loop = asyncio.get_event_loop()
     await asyncio.gather(
         loop.run_in_executor(None, pet_rag.setup_with_cache),
-        loop.run_in_executor(None, shop_rag.setup, True)
+        loop.run_in_executor(None, shop_rag.setup, True, request_shop_reindex)
     )
     
     print(f"Tất cả chatbot đã sẵn sàng! ({round(time.time() - start_time, 2)}s)")
@@ -67,6 +77,18 @@ async def load_models_on_startup():
 class ChatRequest(BaseModel):
     message: str
 
+class BatchChatRequest(BaseModel):
+    messages: list[Annotated[str, StringConstraints(strip_whitespace=True, min_length=1)]] = Field(..., min_length=1, max_length=200)
+    max_concurrency: int = Field(4, ge=1, le=16)
+
+class PetEntryRequest(BaseModel):
+    question: str
+    answers: str
+
+class PetEntryUpdate(BaseModel):
+    question: str | None = None
+    answers: str | None = None
+
 SHOP_KEYWORDS = [
     "shop", "cửa hàng", "địa chỉ", "vận chuyển", "ship", "giao hàng",
     "giá", "bán", "sản phẩm", "mua", "thanh toán", "khuyến mãi", "sale",
@@ -100,13 +122,120 @@ async def chat_endpoint(req: ChatRequest):
         "time": result.get("processing_time", result.get("time", 0))
     }
 
+@app.post("/chat/batch")
+async def chat_batch_endpoint(req: BatchChatRequest):
+    """
+    Trả lời nhiều câu hỏi trong 1 lần gọi (cho job precompute FAQ / gợi ý).
+    Mỗi loại (pet/shop) embed cả lô trong 1 request và search FAISS 1 lần,
+    phần gọi LLM chạy song song tối đa max_concurrency luồng mỗi loại.
+    """
+    if not pet_rag or not shop_rag:
+        return {"results": [], "type": "loading",
+                "response": "Bot đang khởi động, vui lòng chờ 1-2 phút và thử lại..."}
+
+    start = time.time()
+    queries = req.messages
+    groups = {"pet": [], "shop": []}
+    for i, query in enumerate(queries):
+        groups[detect_query_type(query)].append(i)
+    print(f"Batch chat: {len(queries)} câu | pet={len(groups['pet'])} shop={len(groups['shop'])}")
+
+    loop = asyncio.get_event_loop()
+    rags = {"pet": pet_rag, "shop": shop_rag}
+    types = [t for t, idx in groups.items() if idx]
+    outputs = await asyncio.gather(*[
+        loop.run_in_executor(
+            None, partial(rags[t].chat_batch, [queries[i] for i in groups[t]], max_workers=req.max_concurrency)
+        )
+        for t in types
+    ])
+
+    results = [None] * len(queries)
+    for t, output in zip(types, outputs):
+        for i, result in zip(groups[t], output):
+            if result["status"] != "ok":
+                results[i] = {"index": i, "status": "error", "error": result["error"], "type": t}
+                continue
+            results[i] = {
+                "index": i,
+                "status": "ok",
+                "response": result["response"],
+                "sources": result.get("similar_documents") or result.get("sources"),
+                "type": t,
+                "time": result.get("processing_time", result.get("time", 0))
+            }
+
+    return {"results": results, "time": round(time.time() - start, 2)}
+
 @app.post("/admin/reindex/shop")
 async def reindex_shop():
     if not shop_rag:
         return {"success": False, "error": "Bot chưa sẵn sàng"}
+    job, created = jobs.submit("reindex_shop", shop_rag.reload_index)
+    return {
+        "success": True,
+        "message": "Shop reindex started" if created else "Shop reindex already running",
+        "deduplicated": not created,
+        **job.to_dict()
+    }
+
+@app.get("/admin/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        return {"success": False, "error": "Không tìm thấy job"}
+    return {"success": True, **job.to_dict()}
+
+@app.post("/admin/jobs/{job_id}/cancel")
+async def cancel_job(job_id: str):
+    job = jobs.cancel(job_id)
+    if job is None:
+        return {"success": False, "error": "Không tìm thấy job"}
+    return {"success": True, **job.to_dict()}
+
+# === Pet knowledge base: cập nhật từng phần, không chặn /chat ===
+# Embedding chạy trong executor, index mới được đổi vào sau khi build xong.
+@app.post("/admin/pet/entries")
+async def add_pet_entry(req: PetEntryRequest):
+    if not pet_rag:
+        return {"success": False, "error": "Bot chưa sẵn sàng"}
+    try:
+        loop = asyncio.get_event_loop()
+        doc_id = await loop.run_in_executor(None, pet_rag.add_entry, req.question, req.answers)
+        return {"success": True, "doc_id": doc_id}
+    except Exception as e:
+        return {"success": False, "error": str(e)}
+
+@app.put("/admin/pet/entries/{doc_id}")
+async def update_pet_entry(doc_id: int, req: PetEntryUpdate):
+    if not pet_rag:
+        return {"success": False, "error": "Bot chưa sẵn sàng"}
+    try:
+        loop = asyncio.get_event_loop()
+        changed = await loop.run_in_executor(None, pet_rag.update_entry, doc_id, req.question, req.answers)
+        return {"success": True, "doc_id": doc_id, "changed": changed}
+    except Exception as e:
+        return {"success": False, "error": str(e)}
+
+@app.delete("/admin/pet/entries/{doc_id}")
+async def delete_pet_entry(doc_id: int):
+    if not pet_rag:
+        return {"success": False, "error": "Bot chưa sẵn sàng"}
+    try:
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, pet_rag.delete_entry, doc_id)
+        return {"success": True, "doc_id": doc_id}
+    except Exception as e:
+        return {"success": False, "error": str(e)}
+
+@app.post("/admin/reindex/pet")
+async def reindex_pet():
+    if not pet_rag:
+        return {"success": False, "error": "Bot chưa sẵn sàng"}
     try:
-        shop_rag.reload_index()
-        return {"success": True, "message": "Shop index reloaded"}
+        loop = asyncio.get_event_loop()
+        stats = await loop.run_in_executor(None, pet_rag.reload_from_source)
+        return {"success": True, "message": "Pet index reloaded", **stats}
     except Exception as e:
         return {"success": False, "error": str(e)}
 